@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import math, logging
+
+import numpy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+logger = logging.getLogger(__name__)
+
+
+def noise_floor(buf, samples=4096):
+    """Estimate RMS of noise in samples buffer
+
+    Uses median of squared magnitude of evenly spaced subsample, so bursts covering less
+    than half of buffer don't raise the estimate (median of |x|^2 is RMS^2 * ln(2) for complex Gaussian noise).
+    """
+    if not len(buf):
+        return -1.0
+    sub = buf[::max(1, len(buf) // samples)]
+    pwr = sub.real.astype(numpy.float64)**2 + sub.imag.astype(numpy.float64)**2
+    return math.sqrt(float(numpy.median(pwr)) / math.log(2))
+
+
+def dynamic_threshold(noise, threshold):
+    """Return detection threshold derived from noise floor estimate"""
+    if noise is not None and noise < threshold:
+        return noise * 100
+    return threshold
+
+
+def _scan_numpy(buf, thresh_sq, min_burst):
+    """Find first burst in samples buffer (NumPy fallback of scan())"""
+    # Squared magnitude (no sqrt per sample), compared against squared threshold
+    pwr = buf.real * buf.real
+    pwr += buf.imag * buf.imag
+
+    # No sample exceeds threshold (common case)
+    peak_sq = float(pwr.max())
+    if peak_sq <= thresh_sq:
+        return (-1, -1, math.sqrt(peak_sq))
+
+    burst = numpy.flatnonzero(pwr > thresh_sq)
+    gaps = numpy.flatnonzero(numpy.diff(burst) > min_burst)
+    stop = burst[gaps[0]] if gaps.size else burst[-1]
+    return (int(burst[0]), int(stop), math.sqrt(peak_sq))
+
+
+def _scan_loop(buf, thresh_sq, min_burst):
+    """Find first burst in samples buffer (compiled by Numba)"""
+    n = buf.shape[0]
+
+    # Branch-free peak reduction first, it is enough if no sample exceeds threshold
+    peak_sq = 0.0
+    for i in range(n):
+        p = buf[i].real * buf[i].real + buf[i].imag * buf[i].imag
+        peak_sq = max(peak_sq, p)
+
+    if peak_sq <= thresh_sq:
+        return (-1, -1, math.sqrt(peak_sq))
+
+    # Compare squared magnitude against squared threshold (no sqrt per sample)
+    start = -1
+    stop = -1
+    last = -1
+    for i in range(n):
+        p = buf[i].real * buf[i].real + buf[i].imag * buf[i].imag
+        if p > thresh_sq:
+            if start < 0:
+                start = i
+                last = i
+            elif stop < 0:
+                if i - last > min_burst:
+                    stop = last
+                else:
+                    last = i
+
+    if stop < 0:
+        stop = last
+
+    return (start, stop, math.sqrt(peak_sq))
+
+
+if numba:
+    _scan_jit = numba.njit(cache=True, fastmath=True, boundscheck=False)(_scan_loop)
+
+    def scan(buf, thresh_sq, min_burst):
+        """Find first burst in samples buffer (thresh_sq is squared magnitude threshold)
+
+        Returns tuple (start, stop, peak_mag), start and stop are -1 if no sample exceeds threshold.
+        """
+        return _scan_jit(buf, float(thresh_sq), int(min_burst))
+else:
+    logger.debug('numba not available, using NumPy burst detection')
+
+    def scan(buf, thresh_sq, min_burst):
+        """Find first burst in samples buffer (thresh_sq is squared magnitude threshold)
+
+        Returns tuple (start, stop, peak_mag), start and stop are -1 if no sample exceeds threshold.
+        """
+        return _scan_numpy(buf, thresh_sq, min_burst)
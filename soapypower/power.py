@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 
-import sys, time, datetime, math, logging, signal
+import sys, time, math, logging, signal, queue, threading, concurrent.futures, base64
 
 import numpy
 import simplesoapy
 from simplespectral import zeros
-from soapypower import psd, writer
+from soapypower import psd, writer, udp, _burst
 import socket
-import matplotlib.pyplot as plt
+
+try:
+    import orjson
+except ImportError:
+    import json
+    orjson = None
 
 logger = logging.getLogger(__name__)
 _shutdown = False
@@ -27,6 +32,43 @@ if sys.platform == 'win32':
     signal.signal(signal.SIGBREAK, _shutdown_handler)
 
 
+def _render_plot(signal, pwr_array):
+    """Plot time domain and PSD of detected signal to PNG file in /tmp"""
+    # Import matplotlib only when plotting is enabled (and always use non-interactive backend)
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10,5))
+    fig.suptitle("F "+str(round(signal["freq"]/1e6,3))+"MHz W "+str(round(signal["bandwidth"]/1e3))+"KHz D "+str(round(signal["duration"]*1e3,3))+"ms")
+    ax1.plot(signal["td_array"])
+    ax2.plot(pwr_array)
+    fig.savefig("/tmp/"+str(writer.ns_to_datetime(signal["reportTime"]))+".png")
+    plt.close(fig)
+
+
+def _log_plot_error(future):
+    """Log exception raised by plot rendering in writer thread"""
+    e = future.exception()
+    if e is not None:
+        logger.error('Plotting failed: {}'.format(e), exc_info=e)
+
+
+def _dump_json(obj):
+    """Serialize signal measurement to JSON bytes (with orjson if it is available)"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj).encode('utf-8')
+
+
+def _encode_psd(pwr_array):
+    """Encode PSD as base64 string of unsigned bytes (integer dBm + 128, clipped to -128 - 127 dBm)"""
+    # Clip in float first (casting -inf or NaN to integer is undefined)
+    pwr = numpy.clip(numpy.nan_to_num(pwr_array, nan=-128, posinf=127, neginf=-128), -128, 127)
+    psd = (pwr.astype(numpy.int32) + 128).astype(numpy.uint8)
+    return base64.b64encode(psd.tobytes()).decode('ascii')
+
+
 class SoapyPower:
     """SoapySDR spectrum analyzer"""
     def __init__(self, soapy_args='', sample_rate=2.00e6, bandwidth=0, corr=0, gain=20.7,
@@ -48,18 +90,31 @@ class SoapyPower:
         self.port = port
         self._buffer = None
         self._buffer_repeats = None
+        self._slab_ring = None
+        self._slab_free = None
         self._base_buffer_size = None
         self._max_buffer_size = None
         self._bins = None
         self._repeats = None
         self._tune_delay = None
         self._reset_stream = None
+        self._abs_threshold = None
+        self._min_burst = None
         self._psd = None
         self._writer = None
         self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Large send buffer and non-blocking sends, so bursts of reports never stall acquisition
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024**2)
+        self.sock.setblocking(False)
+        self._sender = udp.BatchSender(self.sock, (self.server, self.port))
         self.count = 0
         self.plotting = plot
+        self._noise_ewma = {}
+        self._noise_lock = threading.Lock()
+
+    def dynamic_threshold(self, noise, threshold):
+        """Return detection threshold derived from noise floor estimate"""
+        return _burst.dynamic_threshold(noise, threshold)
 
     def nearest_freq(self, freq, bin_size):
         """Return nearest frequency based on bin size"""
@@ -118,7 +173,7 @@ class SoapyPower:
         min_center_freq = min_freq + (hop_size / 2) if hopping else min_freq + (freq_range / 2)
         max_center_freq = min_center_freq + ((hops - 1) * hop_size)
 
-        freq_list = [min_center_freq + (i * hop_size) for i in range(hops)]
+        freq_list = (min_center_freq + numpy.arange(hops, dtype=numpy.float64) * hop_size).tolist()
 
         if not quiet:
             logger.info('overlap: {:.5f}'.format(overlap))
@@ -139,14 +194,15 @@ class SoapyPower:
             logger.info('threshold abs: {}'.format((10 ** (self.threshold/10))* self.scale))
             logger.info('server: {} '.format(self.server))
             logger.info('port: {} '.format(self.port))
-            logger.debug('Frequency hops table:')
-            logger.debug('  {:8s}      {:8s}      {:8s}'.format('Min:', 'Center:', 'Max:'))
-            for f in freq_list:
-                logger.debug('  {:8.3f} MHz  {:8.3f} MHz  {:8.3f} MHz'.format(
-                    (f - (self.device.sample_rate / 2)) / 1e6,
-                    f / 1e6,
-                    (f + (self.device.sample_rate / 2)) / 1e6,
-                ))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Frequency hops table:')
+                logger.debug('  {:8s}      {:8s}      {:8s}'.format('Min:', 'Center:', 'Max:'))
+                for f in freq_list:
+                    logger.debug('  {:8.3f} MHz  {:8.3f} MHz  {:8.3f} MHz'.format(
+                        (f - (self.device.sample_rate / 2)) / 1e6,
+                        f / 1e6,
+                        (f + (self.device.sample_rate / 2)) / 1e6,
+                    ))
 
         return freq_list
 
@@ -201,9 +257,26 @@ class SoapyPower:
         )
         self._tune_delay = tune_delay
         self._reset_stream = reset_stream
+        self._noise_ewma = {}
+
+        # initial threshold...
+        self._abs_threshold = (10 ** (self.threshold/10)) * self.scale
+        # Only interested in bursts of power > 5us
+        self._min_burst = int(0.000005 * self.device.sample_rate)
+
         self._psd = psd.PSD(bins, self.device.sample_rate, fft_window=fft_window, fft_overlap=fft_overlap,
                             crop_factor=crop_factor, log_scale=log_scale, remove_dc=remove_dc, detrend=detrend,
                             lnb_lo=lnb_lo, max_threads=max_threads, max_queue_size=max_queue_size)
+
+        # Ring of sample slabs, filled in main thread and processed in PSD threads
+        # (at most 4 slabs and about 200 MB in total, but always at least 2 to overlap reading with processing)
+        slabs = min(self._psd._executor._max_workers + 1, 4, (200 * 1024**2) // self._buffer.nbytes)
+        slabs = max(slabs, 2)
+        self._slab_ring = [self._buffer] + [zeros(len(self._buffer), numpy.complex64) for i in range(slabs - 1)]
+        logger.info('slab_ring: {} slabs ({:.1f} MB)'.format(slabs, slabs * self._buffer.nbytes / 1024**2))
+        self._slab_free = queue.SimpleQueue()
+        for i in range(len(self._slab_ring)):
+            self._slab_free.put(i)
         self._writer = writer.formats[self._output_format](self._output)
 
     def stop(self):
@@ -220,20 +293,38 @@ class SoapyPower:
         self._max_buffer_size = None
         self._buffer_repeats = None
         self._buffer = None
+        self._slab_ring = None
+        self._slab_free = None
         self._tune_delay = None
         self._reset_stream = None
+        self._abs_threshold = None
+        self._min_burst = None
         self._psd = None
         self._writer = None
 
     def psd(self, freq):
-        """Tune to specified center frequency and compute Power Spectral Density"""
+        """Tune to specified center frequency and compute Power Spectral Density
+
+        Returns tuple (psd_future, acq_time_start, acq_time_stop, signal), acquisition times
+        are UNIX timestamps in nanoseconds.
+        """
         if not self.device.is_streaming:
             raise RuntimeError('Streaming is not initialized, you must run setup() first!')
 
         # Tune to new frequency in main thread
         logger.debug('  Frequency hop: {:.2f} Hz'.format(freq))
         t_freq = time.time()
-        signal = {"start": -1, "stop": 0, "samples": 0, "duration": 0}
+        self._tune(freq)
+        t_freq_end = time.time()
+        logger.debug('    Tune time: {:.6f} s'.format(t_freq_end - t_freq))
+
+        psd_future, acq_time_start, acq_time_stop, signal = self._acquire(freq)
+        logger.debug('    Total hop time: {:.6f} s'.format(time.time() - t_freq))
+
+        return (psd_future, acq_time_start, acq_time_stop, signal)
+
+    def _tune(self, freq):
+        """Tune to specified center frequency (if it differs from current one)"""
         if self.device.freq != freq:
             # Deactivate streaming before tuning
             if self._reset_stream:
@@ -257,87 +348,129 @@ class SoapyPower:
                 logger.debug('    Tune delay: {:.6f} s'.format(t_delay_end - t_delay))
         else:
             logger.debug('    Same frequency as before, tuning skipped')
-        psd_state = self._psd.set_center_freq(freq)
-        t_freq_end = time.time()
-        logger.debug('    Tune time: {:.6f} s'.format(t_freq_end - t_freq))
 
-        # Only interested in bursts of power > 5us
-        minBurst = int(0.000005 * self.device.sample_rate)
+    def _acquire(self, freq):
+        """Acquire samples at current center frequency and start burst detection in PSD threads"""
+        signal = {"start": -1, "stop": 0, "samples": 0, "duration": 0}
+        psd_state = self._psd.set_center_freq(freq)
 
-        # initial threshold...
-        absThreshold = (10 ** (self.threshold/10)) * self.scale
+        hop = {
+            'signal': signal,
+            'repeat': -1,
+            'lock': threading.Lock(),
+        }
 
         for repeat in range(self._buffer_repeats):
             logger.debug('    Repeat: {}'.format(repeat + 1))
-            # Read samples from SDR in main thread
-            t_acq = time.time()
-
-            acq_time_start = datetime.datetime.utcnow() # not accurate.
-            self.device.read_stream_into_buffer(self._buffer)
-
-            acq_time_stop = datetime.datetime.utcnow()
-            t_acq_end = time.time()
-            logger.debug('      Acquisition time: {:.6f} s'.format(t_acq_end - t_acq))
-	
-            iq = self._buffer.real+self._buffer.imag
- 
-            # dynamic threshold
-            noise = abs(numpy.mean(iq[:100]))
-            if noise < absThreshold:
-              absThreshold = noise * 100
-              #print("Threshold set to %.4f" % absThreshold)
+            # Read samples from SDR into free slab in main thread (blocks until some slab is released)
+            slab_idx = self._slab_free.get()
+            acq_time_start = time.time_ns() # not accurate.
+            self.device.read_stream_into_buffer(self._slab_ring[slab_idx])
 
-            # Only interested in processing power
-            if numpy.max(iq) > absThreshold:
-              
-              # Array of power values which exceed absThreshold
-              burst = numpy.where(numpy.abs(iq) > absThreshold)[0]
-
-              #print(absThreshold,len(burst))
-              # Start power is easy :)
-              start = burst[0]
-
-              # Stop is trickier :p
-              # Search burst for the last value above the absThreshold which must be followed by a gap of minBurst samples to be sure.
-              delta=0
-              laststop=start
-              for stop in burst:
-                delta=stop-laststop
-                if delta > minBurst:
-                  stop = laststop
-                  break
-                laststop=stop
-              
-              if stop-start > minBurst:  
-                safestart=0
-                safestop = len(iq) -1
-                if start > minBurst:
-                    safestart = start-minBurst
-                if safestop-stop > minBurst:
-                    safestop = stop+minBurst
-
-                signal["freq"] = freq
-                signal["start"] = start
-                signal["stop"] = stop
-                signal["samples"] = stop-start
-                signal["duration"] = ((stop-start)/self.device.sample_rate)
-                signal["td_array"] = numpy.abs(iq[safestart:safestop])
-                signal["reportTime"] = acq_time_start
-                signal["rate"] = self.device.sample_rate
-
-                # Start FFT computation in another thread
-                self._psd.update_async(psd_state, numpy.copy(self._buffer[start:stop]))
-
-            t_final = time.time()
+            acq_time_stop = time.time_ns()
+            logger.debug('      Acquisition time: {:.6f} s'.format((acq_time_stop - acq_time_start) / 1e9))
+
+            # Detect burst and compute FFT in another thread
+            future = self._psd._executor.submit(
+                self._detect, psd_state, hop, slab_idx, freq, repeat, acq_time_start
+            )
+            psd_state['futures'].append(future)
 
             if _shutdown:
                 break
 
         psd_future = self._psd.result_async(psd_state)
-        logger.debug('    Total hop time: {:.6f} s'.format(t_final - t_freq))
-
         return (psd_future, acq_time_start, acq_time_stop, signal)
 
+    def _detect(self, psd_state, hop, slab_idx, freq, repeat, acq_time_start):
+        """Find burst in samples slab and update PSD with it (releases slab when finished)"""
+        slab = self._slab_ring[slab_idx]
+        minBurst = self._min_burst
+        try:
+            # dynamic threshold (from moving average of noise floor at this frequency, including this slab,
+            # shared lock because slabs of consecutive runs at the same frequency can be detected concurrently)
+            noise = _burst.noise_floor(slab)
+            with self._noise_lock:
+                ewma = self._noise_ewma.get(freq)
+                ewma = noise if ewma is None else 0.9 * ewma + 0.1 * noise
+                self._noise_ewma[freq] = ewma
+            threshold = self.dynamic_threshold(ewma, self._abs_threshold)
+
+            # Find first burst in one pass over samples
+            start, stop, peak = _burst.scan(slab, threshold ** 2, minBurst)
+
+            # Only interested in processing power
+            if start < 0 or stop-start <= minBurst:
+                return
+
+            safestart=0
+            safestop = len(slab) -1
+            if start > minBurst:
+                safestart = start-minBurst
+            if safestop-stop > minBurst:
+                safestop = stop+minBurst
+            td_array = numpy.abs(slab[safestart:safestop])
+
+            self._psd.update(psd_state, slab[start:stop])
+
+            # Report burst from the latest repeat
+            with hop['lock']:
+                if repeat > hop['repeat']:
+                    hop['repeat'] = repeat
+                    hop['signal'].update({
+                        "freq": freq,
+                        "start": start,
+                        "stop": stop,
+                        "samples": stop-start,
+                        "duration": ((stop-start)/self.device.sample_rate),
+                        "td_array": td_array,
+                        "reportTime": acq_time_start,
+                        "rate": self.device.sample_rate,
+                    })
+        finally:
+            self._slab_free.put(slab_idx)
+
+    def _report(self, psd_future, acq_time_start, acq_time_stop, signal):
+        """Wait for PSD of one frequency hop and send measurement of detected signal"""
+        concurrent.futures.wait([psd_future])
+        if signal["start"] > -1:
+          payload = self.measurements(psd_future, len(self._buffer) * self._buffer_repeats, signal)
+          if payload:
+            self._sender.send(payload)
+            print(self.count,payload.decode('utf-8'))
+            self.count +=1 
+
+    def _sweep_single(self, freq, runs=0, time_limit=0, flush_interval=0.1):
+        """Monitor single center frequency (tune only once and just keep acquiring samples)"""
+        self._tune(freq)
+
+        t_start = time.time()
+        t_flush = t_start
+        run = 0
+        pending = None
+        while not _shutdown and (runs == 0 or run < runs):
+            run += 1
+            hop = self._acquire(freq)
+
+            # Report previous run while current one is processed in PSD threads
+            if pending:
+                self._report(*pending)
+            pending = hop
+
+            # There is no end of frequency list, send queued signal measurements periodically
+            t_run = time.time()
+            if t_run - t_flush >= flush_interval:
+                self._sender.flush()
+                t_flush = t_run
+
+            # End measurement if time limit is exceeded
+            if time_limit and (t_run - t_start) >= time_limit:
+                logger.info('Time limit of {} s exceeded, completed {} runs'.format(time_limit, run))
+                break
+
+        if pending:
+            self._report(*pending)
+
     def sweep(self, min_freq, max_freq, bins, repeats, runs=0, time_limit=0, overlap=0,
               fft_window='hann', fft_overlap=0.5, crop=False, log_scale=True, remove_dc=False, detrend=None, lnb_lo=0,
               tune_delay=0, reset_stream=False, base_buffer_size=0, max_buffer_size=0, max_threads=0, max_queue_size=0):
@@ -352,40 +485,51 @@ class SoapyPower:
         try:
             freq_list = self.freq_plan(min_freq - lnb_lo, max_freq - lnb_lo, bins, overlap)
             t_start = time.time()
-            run = 0
-            while not _shutdown and (runs == 0 or run < runs):
-                run += 1
-                t_run_start = time.time()
-                logger.debug('Run: {}'.format(run))
-
-                for freq in freq_list:
-                    # Tune to new frequency, acquire samples and compute Power Spectral Density
-                    psd_future, acq_time_start, acq_time_stop, signal = self.psd(freq)
-
-                    if signal["start"] > -1:
-                      json = self.measurements(psd_future, len(self._buffer) * self._buffer_repeats, signal)
-                      if json:
-                        self.sock.sendto(json.encode('utf-8'), (self.server, self.port))
-                        print(self.count,json)
-                        self.count +=1 
-                    if _shutdown:
+            if len(freq_list) == 1:
+                # No frequency hopping, use specialized loop without tuning
+                self._sweep_single(freq_list[0], runs=runs, time_limit=time_limit)
+            else:
+                run = 0
+                while not _shutdown and (runs == 0 or run < runs):
+                    run += 1
+                    t_run_start = time.time()
+                    logger.debug('Run: {}'.format(run))
+
+                    pending = None
+                    for freq in freq_list:
+                        # Tune to new frequency, acquire samples and compute Power Spectral Density
+                        hop = self.psd(freq)
+
+                        # Report previous hop while current one is processed in PSD threads
+                        if pending:
+                            self._report(*pending)
+                        pending = hop
+
+                        if _shutdown:
+                            break
+
+                    if pending:
+                        self._report(*pending)
+
+                    # Send queued signal measurements at the end of frequency list
+                    self._sender.flush()
+
+                    # Write end of measurement marker (in another thread)
+                    #write_next_future = self._writer.write_next_async()
+                    t_run = time.time()
+                    logger.debug('  Total run time: {:.3f} s'.format(t_run - t_run_start))
+
+                    # End measurement if time limit is exceeded
+                    if time_limit and (time.time() - t_start) >= time_limit:
+                        logger.info('Time limit of {} s exceeded, completed {} runs'.format(time_limit, run))
                         break
 
-                # Write end of measurement marker (in another thread)
-                #write_next_future = self._writer.write_next_async()
-                t_run = time.time()
-                logger.debug('  Total run time: {:.3f} s'.format(t_run - t_run_start))
-
-                # End measurement if time limit is exceeded
-                if time_limit and (time.time() - t_start) >= time_limit:
-                    logger.info('Time limit of {} s exceeded, completed {} runs'.format(time_limit, run))
-                    break
-
             # Wait for last write to be finished
             #write_next_future.result()
 
             # Debug thread pool queues
             logging.debug('Number of USB buffer overflow errors: {}'.format(self.device.buffer_overflow_count))
+            logging.debug('Number of dropped UDP datagrams: {}'.format(self._sender.dropped_count))
             logging.debug('PSD worker threads: {}'.format(self._psd._executor._max_workers))
             logging.debug('Max. PSD queue size: {} / {}'.format(self._psd._executor.max_queue_size_reached,
                                                                 self._psd._executor.max_queue_size))
@@ -393,7 +537,8 @@ class SoapyPower:
             logging.debug('Max. Writer queue size: {} / {}'.format(self._writer._executor.max_queue_size_reached,
                                                                    self._writer._executor.max_queue_size))
         finally:
-            # Shutdown SDR
+            # Send remaining signal measurements and shutdown SDR
+            self._sender.flush()
             self.stop()
             t_stop = time.time()
             logger.info('Total time: {:.3f} s'.format(t_stop - t_start))
@@ -442,21 +587,25 @@ class SoapyPower:
         else:
           offset = resolution * (centreFreq-midpoint)
 
-        # focused PSD on signal only pwr_array[leftEdge:rightEdge]
-        psd = numpy.int_(numpy.array(pwr_array))
-        psd = (','.join(str(int(v)) for v in psd))
-
+        signal["leftEdge"] = leftEdge
+        signal["rightEdge"] = rightEdge
+        signal["offset"] = offset
 
         # update frequency
         signal["freq"] += offset
-        json = '{\n "reportTime": "%s",\n "frequencyMHz": %.3f,\n "bandwidthKHz": %d,\n "psd": [%s],\n "spanMHz": [%.3f,%.3f], \n "durationMs": %.3f,\n "rssidBm": %.1f\n}\n' % (signal["reportTime"],signal["freq"]/1e6,signal["bandwidth"]/1e3,psd,leftFreq/1e6,rightFreq/1e6,signal["duration"]*1e3,signal["rssi"])
+        payload = _dump_json({
+            "reportTime": writer.ns_to_datetime(signal["reportTime"]).isoformat(),
+            "frequencyMHz": round(signal["freq"]/1e6, 3),
+            "bandwidthKHz": int(signal["bandwidth"]/1e3),
+            "psd_enc": "u8+128dBm",
+            "psd": _encode_psd(pwr_array),
+            "spanMHz": [round(leftFreq/1e6, 3), round(rightFreq/1e6, 3)],
+            "durationMs": round(signal["duration"]*1e3, 3),
+            "rssidBm": round(float(signal["rssi"]), 1),
+        })
 
         if self.plotting:
-          fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10,5))
-          fig.suptitle("F "+str(round(signal["freq"]/1e6,3))+"MHz W "+str(round(signal["bandwidth"]/1e3))+"KHz D "+str(round(signal["duration"]*1e3,3))+"ms")
-          ax1.plot(signal["td_array"])
-          ax2.plot(pwr_array)
-          plt.savefig("/tmp/"+str(signal["reportTime"])+".png")
-          plt.close()
-        
-        return json            
+          # Render plot in writer thread
+          self._writer._executor.submit(_render_plot, signal, pwr_array).add_done_callback(_log_plot_error)
+
+        return payload            
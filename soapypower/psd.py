@@ -1,15 +1,60 @@
 #!/usr/bin/env python3
 
-import math, logging, threading, concurrent.futures
+import os, math, logging, threading, concurrent.futures
 
 import numpy
 import simplespectral
 
+try:
+    import scipy.fft
+    import scipy.signal
+    use_scipy_fft = True
+except ImportError:
+    use_scipy_fft = False
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 from soapypower import threadpool
 
 logger = logging.getLogger(__name__)
 
 
+def _window_segments(samples_array, window, step, detrend, out):
+    """Split samples into overlapping segments, remove mean (optionally) and apply window"""
+    segments, bins = out.shape
+    for s in range(segments):
+        offset = s * step
+        mean = 0j
+        if detrend:
+            for i in range(bins):
+                mean += samples_array[offset + i]
+            mean /= bins
+        for i in range(bins):
+            out[s, i] = (samples_array[offset + i] - mean) * window[i]
+
+
+def _average_power(x, scale, out):
+    """Average squared magnitude of FFT segments and apply density scale"""
+    segments, bins = x.shape
+    acc = numpy.zeros(bins)
+    for s in range(segments):
+        for i in range(bins):
+            acc[i] += x[s, i].real * x[s, i].real + x[s, i].imag * x[s, i].imag
+    scale /= segments
+    for i in range(bins):
+        out[i] = acc[i] * scale
+
+
+if numba:
+    # PSD threads already run in parallel, so kernels are compiled without parallel=True
+    # (workqueue threading layer of Numba doesn't allow concurrent parallel calls)
+    _window_segments = numba.njit(cache=True, fastmath=True)(_window_segments)
+    _average_power = numba.njit(cache=True, fastmath=True)(_average_power)
+
+
 class PSD:
     """Compute averaged power spectral density using Welch's method"""
     def __init__(self, bins, sample_rate, fft_window='hann', fft_overlap=0.5,
@@ -32,6 +77,13 @@ class PSD:
         )
         self._base_freq_array = numpy.fft.fftfreq(self._bins, 1 / self._sample_rate)
 
+        if use_scipy_fft:
+            # Window and density scaling are the same for every segment, compute them only once
+            self._window = scipy.signal.get_window(self._fft_window, self._bins).astype(numpy.float32)
+            self._scale = 1 / (self._sample_rate * numpy.sum(self._window.astype(numpy.float64)**2))
+            # Split available CPUs between PSD threads to avoid oversubscription
+            self._fft_workers = max(1, (os.cpu_count() or 1) // self._executor._max_workers)
+
     def set_center_freq(self, center_freq):
         """Set center frequency and clear averaged PSD data"""
         psd_state = {
@@ -57,7 +109,9 @@ class PSD:
             pwr_array = pwr_array / psd_state['repeats']
 
         if self._log_scale:
-            pwr_array = 10 * numpy.log10(pwr_array)
+            # pwr_array is a copy made by fftshift() (or division above), safe to modify in place
+            numpy.log10(pwr_array, out=pwr_array)
+            pwr_array *= 10
 
         return (freq_array, pwr_array)
 
@@ -77,11 +131,44 @@ class PSD:
         """Remove result from future to release memory"""
         future._result = None
 
+    def welch(self, samples_array):
+        """Compute PSD from samples using Welch's method (with scipy.fft)"""
+        step = self._bins - self._fft_overlap_bins
+        segments = (len(samples_array) - self._fft_overlap_bins) // step
+        samples_array = numpy.ascontiguousarray(samples_array, dtype=numpy.complex64)
+
+        if numba:
+            # Fused detrend + window (before FFT) and power + averaging (after FFT), no temporary arrays
+            x = numpy.empty((segments, self._bins), numpy.complex64)
+            _window_segments(samples_array, self._window, step, self._detrend == 'constant', x)
+            x = scipy.fft.fft(x, n=self._bins, axis=-1, overwrite_x=True, workers=self._fft_workers)
+            pwr_array = numpy.empty(self._bins, numpy.float32)
+            _average_power(x, self._scale, pwr_array)
+        else:
+            x = numpy.lib.stride_tricks.as_strided(
+                samples_array, shape=(segments, self._bins),
+                strides=(step * samples_array.strides[0], samples_array.strides[0]),
+                writeable=False
+            )
+
+            if self._detrend == 'constant':
+                x = x - x.mean(axis=-1, keepdims=True)
+            x = x * self._window
+
+            x = scipy.fft.fft(x, n=self._bins, axis=-1, overwrite_x=True, workers=self._fft_workers)
+            pwr_array = x.real**2 + x.imag**2
+            pwr_array = pwr_array.mean(axis=0)
+            pwr_array *= self._scale
+        return (self._base_freq_array, pwr_array)
+
     def update(self, psd_state, samples_array):
         """Compute PSD from samples and update average for given center frequency"""
-        freq_array, pwr_array = simplespectral.welch(samples_array, self._sample_rate, nperseg=self._bins,
-                                                     window=self._fft_window, noverlap=self._fft_overlap_bins,
-                                                     detrend=self._detrend)
+        if use_scipy_fft and len(samples_array) >= self._bins:
+            freq_array, pwr_array = self.welch(samples_array)
+        else:
+            freq_array, pwr_array = simplespectral.welch(samples_array, self._sample_rate, nperseg=self._bins,
+                                                         window=self._fft_window, noverlap=self._fft_overlap_bins,
+                                                         detrend=self._detrend)
 
         if self._remove_dc:
             pwr_array[0] = (pwr_array[1] + pwr_array[-1]) / 2
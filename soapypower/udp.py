@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import sys, socket, struct, logging, ctypes, ctypes.util
+
+logger = logging.getLogger(__name__)
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def _load_sendmmsg():
+    """Return libc sendmmsg() function or None if it is not available"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+_send_flags = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class BatchSender:
+    """Send UDP datagrams in batches (with sendmmsg() syscall on Linux)"""
+    def __init__(self, sock, address, batch_size=64):
+        self.sock = sock
+        self.address = address
+        self.batch_size = batch_size
+        self._batch = []
+        self._sockaddr = None
+        self.dropped_count = 0
+
+        if _sendmmsg and sock.family == socket.AF_INET:
+            # Resolve hostname once (sendmmsg() needs numeric address)
+            try:
+                host = socket.getaddrinfo(address[0], address[1], socket.AF_INET, socket.SOCK_DGRAM)[0][4][0]
+            except socket.gaierror as e:
+                logger.warning('Can\'t resolve {} ({}), sending UDP datagrams one by one'.format(address[0], e))
+                return
+
+            # struct sockaddr_in (family in host byte order, port and address in network byte order)
+            sockaddr = (struct.pack('=H', socket.AF_INET) + struct.pack('!H', address[1]) +
+                        socket.inet_aton(host) + bytes(8))
+            self._sockaddr = ctypes.create_string_buffer(sockaddr, len(sockaddr))
+
+    def send(self, payload):
+        """Queue datagram and send whole batch if it is full"""
+        self._batch.append(payload)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send all queued datagrams"""
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        sent = self._send_mmsg(batch) if self._sockaddr is not None else 0
+        for payload in batch[sent:]:
+            try:
+                self.sock.sendto(payload, _send_flags, self.address)
+            except BlockingIOError:
+                # Socket send buffer is full, drop datagram instead of blocking
+                self.dropped_count += 1
+            except OSError as e:
+                self.dropped_count += 1
+                logger.debug('UDP send failed: {}'.format(e))
+
+    def _send_mmsg(self, batch):
+        """Send datagrams with one sendmmsg() call, return number of sent datagrams"""
+        n = len(batch)
+        buffers = [ctypes.create_string_buffer(payload, len(payload)) for payload in batch]
+        iovecs = (_iovec * n)()
+        msgs = (_mmsghdr * n)()
+        for i, buf in enumerate(buffers):
+            iovecs[i].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+            iovecs[i].iov_len = len(batch[i])
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(self._sockaddr, ctypes.c_void_p)
+            hdr.msg_namelen = len(self._sockaddr)
+            hdr.msg_iov = ctypes.pointer(iovecs[i])
+            hdr.msg_iovlen = 1
+
+        sent = 0
+        while sent < n:
+            ret = _sendmmsg(self.sock.fileno(), ctypes.addressof(msgs) + sent * ctypes.sizeof(_mmsghdr), n - sent, _send_flags)
+            if ret <= 0:
+                # Let remaining datagrams be sent one by one (and report errors there)
+                break
+            sent += ret
+        return sent
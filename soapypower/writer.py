@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import sys, logging, struct, collections, io
+import sys, logging, struct, collections, io, datetime
 
 import numpy
 
@@ -12,6 +12,11 @@ if sys.platform == 'win32':
 logger = logging.getLogger(__name__)
 
 
+def ns_to_datetime(timestamp_ns):
+    """Convert UNIX timestamp in nanoseconds to naive UTC datetime"""
+    return datetime.datetime.fromtimestamp(timestamp_ns / 1e9, datetime.timezone.utc).replace(tzinfo=None)
+
+
 class BaseWriter:
     """Power Spectral Density writer base class"""
     def __init__(self, output=sys.stdout):
@@ -38,7 +43,7 @@ class BaseWriter:
         )
 
     def write(self, psd_data_or_future, time_start, time_stop, samples):
-        """Write PSD of one frequency hop"""
+        """Write PSD of one frequency hop (time_start and time_stop are UNIX timestamps in nanoseconds)"""
         raise NotImplementedError
 
     def write_async(self, psd_data_or_future, time_start, time_stop, samples):
@@ -77,7 +82,8 @@ class SoapyPowerBinFormat:
         header = self.header._make(
             self.header_struct.unpack(f.read(self.header_struct.size))
         )
-        pwr_array = numpy.fromstring(f.read(header.size), dtype='float32')
+        # Read-only view of read bytes (no extra copy)
+        pwr_array = numpy.frombuffer(f.read(header.size), dtype='<f4')
         return (header, pwr_array)
 
     def write(self, f, time_start, time_stop, start, stop, step, samples, pwr_array):
@@ -113,8 +119,8 @@ class SoapyPowerBinWriter(BaseWriter):
             step = f_array[1] - f_array[0]
             self.formatter.write(
                 self.output,
-                time_start.timestamp(),
-                time_stop.timestamp(),
+                time_start / 1e9,
+                time_stop / 1e9,
                 f_array[0],
                 f_array[-1] + step,
                 step,
@@ -144,13 +150,13 @@ class RtlPowerFftwWriter(BaseWriter):
             f_array, pwr_array = psd_data_or_future
 
         self.output.write('# soapy_power output\n')
-        self.output.write('# Acquisition start: {}\n'.format(time_start))
-        self.output.write('# Acquisition end: {}\n'.format(time_stop))
+        self.output.write('# Acquisition start: {}\n'.format(ns_to_datetime(time_start)))
+        self.output.write('# Acquisition end: {}\n'.format(ns_to_datetime(time_stop)))
         self.output.write('#\n')
         self.output.write('# frequency [Hz] power spectral density [dB/Hz]\n')
 
-        for f, pwr in zip(f_array, pwr_array):
-            self.output.write('{} {}\n'.format(f, pwr))
+        # Format all rows at once (frequency with full float64 precision, power with float32 precision)
+        self.output.write(('%.15g %.7g\n' * len(f_array)) % tuple(numpy.column_stack((f_array, pwr_array)).ravel().tolist()))
 
         self.output.write('\n')
         self.output.flush()
@@ -177,6 +183,7 @@ class RtlPowerWriter(BaseWriter):
 
         try:
             step = f_array[1] - f_array[0]
+            time_stop = ns_to_datetime(time_stop)
             row = [
                 time_stop.strftime('%Y-%m-%d'), time_stop.strftime('%H:%M:%S'),
                 f_array[0], f_array[-1] + step, step, samples
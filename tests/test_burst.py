@@ -0,0 +1,42 @@
+import numpy
+import pytest
+
+from soapypower import _burst
+
+NOISE_RMS = 1.4e-3
+# -85 dBm with default scale (configured absolute threshold)
+ABS_THRESHOLD = 10 ** (-85 / 10) * 2e9
+BURST_AMPLITUDE = 0.5
+
+
+def make_buffer(size=100000, burst=slice(40000, 60000), amplitude=BURST_AMPLITUDE, seed=0):
+    rng = numpy.random.default_rng(seed)
+    buf = (rng.normal(scale=NOISE_RMS / numpy.sqrt(2), size=size) +
+           1j * rng.normal(scale=NOISE_RMS / numpy.sqrt(2), size=size)).astype(numpy.complex64)
+    buf[burst] += amplitude
+    return buf
+
+
+def test_noise_floor_ignores_burst():
+    buf = make_buffer()
+    assert _burst.noise_floor(buf) == pytest.approx(NOISE_RMS, rel=0.25)
+
+
+@pytest.mark.parametrize('scan', [_burst.scan, _burst._scan_numpy])
+def test_weak_burst_detected(scan):
+    # Burst is stronger than noise * 100 but weaker than configured threshold
+    assert NOISE_RMS * 100 < BURST_AMPLITUDE < ABS_THRESHOLD
+
+    buf = make_buffer()
+    threshold = _burst.dynamic_threshold(_burst.noise_floor(buf), ABS_THRESHOLD)
+    start, stop, peak = scan(buf, threshold ** 2, 25)
+    assert start == 40000
+    assert stop == 59999
+
+
+@pytest.mark.parametrize('scan', [_burst.scan, _burst._scan_numpy])
+def test_no_burst_below_threshold(scan):
+    buf = make_buffer()
+    start, stop, peak = scan(buf, (BURST_AMPLITUDE * 2) ** 2, 25)
+    assert (start, stop) == (-1, -1)
+    assert peak == pytest.approx(numpy.abs(buf).max(), rel=1e-5)